@@ -1,33 +1,75 @@
 import os
+import errno
+import mmap
 import time
 import argparse
-import multiprocessing
 import tempfile
-import glob
+import threading
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
 from typing import List, Tuple
 import duckdb
 from tqdm import tqdm
 
+DOMAIN_COLUMNS = ['domain', 'nameservers', 'ip', 'country', 'server',
+                  'field5', 'field6', 'field7', 'field8']
+
+# Schema for the domains table, issued once per database file
+DOMAINS_DDL = f"""
+CREATE TABLE IF NOT EXISTS domains (
+    {', '.join(f'{column} VARCHAR' for column in DOMAIN_COLUMNS)}
+);
+"""
+
+# Rows to accumulate before refreshing the chunked-load progress bar
+PROGRESS_BATCH_ROWS = 1_000_000
+
+# errno values from sendfile() on platforms where it can't write into a pipe
+SENDFILE_UNSUPPORTED = {errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP, errno.ENOSYS}
+
+# Per-thread state for chunk workers, set up once by _init_worker
+_worker = threading.local()
+
 def parse_args():
     parser = argparse.ArgumentParser(description='Ultra-fast loading of large domain dataset')
     parser.add_argument('--file', type=str, required=True, help='Path to the data file')
     parser.add_argument('--db-path', type=str, default='domains.duckdb', help='Path to DuckDB file')
     parser.add_argument('--workers', type=int, default=4, 
-                        help='Number of worker processes (default: 4)')
+                        help='Number of concurrent chunk loaders (default: 4)')
     parser.add_argument('--chunk-size', type=int, default=250000, 
-                        help='Rows per chunk for multiprocess loading')
+                        help='Rows per chunk for chunked loading')
     parser.add_argument('--direct', action='store_true', 
-                        help='Use direct COPY statement instead of chunking')
+                        help='Use a single parallel COPY statement (default)')
+    parser.add_argument('--chunked', action='store_true', 
+                        help='Fall back to chunked loading through concurrent cursors')
+    parser.add_argument('--to-parquet', action='store_true', 
+                        help='Convert the input to <file>.parquet once and load from it')
     parser.add_argument('--memory-limit', type=str, default='8GB', 
                         help='Memory limit for DuckDB')
     parser.add_argument('--compression', choices=['none', 'uncompressed', 'gzip', 'zstd'], 
                         default='none', help='Input file compression')
-    parser.add_argument('--temp-dir', type=str, default='./temp_dbs', 
-                        help='Directory for temporary databases')
+    parser.add_argument('--temp-dir', type=str, default=None, 
+                        help='Parent directory for DuckDB spill files (default: next to the database file)')
     return parser.parse_args()
 
+def check_allocator(conn: duckdb.DuckDBPyConnection):
+    """Warn when DuckDB is running on the default system allocator."""
+    # DuckDB's glibc Linux builds statically bundle jemalloc under prefixed
+    # symbols; it isn't listed in duckdb_extensions() and LD_PRELOAD can't
+    # replace it. Other builds (macOS, Windows, musl) use the system malloc
+    platform = conn.execute("PRAGMA platform").fetchone()[0]
+    if platform.startswith('linux_') and not platform.endswith('_musl'):
+        # Let jemalloc return freed memory from background threads
+        try:
+            conn.execute("SET allocator_background_threads=true")
+        except:
+            pass
+        return
+    
+    print(f"Note: this DuckDB build ({platform}) uses the system allocator, "
+          "which can become a bottleneck for multi-threaded loads.")
+
 def setup_database(db_path: str, memory_limit: str) -> duckdb.DuckDBPyConnection:
     """Initialize the database with optimal settings."""
     conn = duckdb.connect(db_path)
@@ -35,30 +77,22 @@ def setup_database(db_path: str, memory_limit: str) -> duckdb.DuckDBPyConnection
     # Configure DuckDB for performance
     conn.execute(f"PRAGMA memory_limit='{memory_limit}'")
     
-    # Set threads to CPU count
-    thread_count = max(1, multiprocessing.cpu_count() // 2)  # Use half the cores for each connection
-    conn.execute(f"PRAGMA threads={thread_count}")
+    # Set threads to CPU count; this is the only DuckDB engine on the box
+    conn.execute(f"PRAGMA threads={os.cpu_count() or 1}")
+    
+    # Bulk loads don't need row order kept (explicit ORDER BY is still honored)
+    conn.execute("PRAGMA preserve_insertion_order=false")
     
     # Enable optimizations if available
     try:
         conn.execute("PRAGMA enable_object_cache")
     except:
         pass
+    
+    check_allocator(conn)
         
     # Create the table with optimized schema
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS domains (
-        domain VARCHAR,
-        nameservers VARCHAR,
-        ip VARCHAR,
-        country VARCHAR,
-        server VARCHAR,
-        field5 VARCHAR,
-        field6 VARCHAR,
-        field7 VARCHAR,
-        field8 VARCHAR
-    );
-    """)
+    conn.execute(DOMAINS_DDL)
     return conn
 
 def get_file_chunks(file_path: str, total_rows: int, chunk_size: int) -> List[Tuple[int, int]]:
@@ -68,279 +102,418 @@ def get_file_chunks(file_path: str, total_rows: int, chunk_size: int) -> List[Tu
     chunk_bytes = int(approx_bytes_per_row * chunk_size)
     
     chunks = []
-    with open(file_path, 'rb') as f:
-        start_pos = 0
-        while start_pos < file_size:
-            end_pos = min(start_pos + chunk_bytes, file_size)
-            
-            # Move to end of line
-            if end_pos < file_size:
-                f.seek(end_pos)
-                while end_pos < file_size:
-                    char = f.read(1)
-                    end_pos += 1
-                    if char == b'\n':
-                        break
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        # The chunks are read front to back; ask for larger kernel readahead
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
             
-            chunks.append((start_pos, end_pos))
-            start_pos = end_pos
+            start_pos = 0
+            while start_pos < file_size:
+                end_pos = min(start_pos + chunk_bytes, file_size)
+                
+                # Move to end of line (single memchr instead of byte-wise reads)
+                if end_pos < file_size:
+                    nl = mm.find(b'\n', end_pos)
+                    end_pos = file_size if nl == -1 else nl + 1
+                
+                chunks.append((start_pos, end_pos))
+                start_pos = end_pos
+    finally:
+        os.close(fd)
     
     return chunks
 
-def process_chunk(chunk_info: Tuple[int, Tuple[int, int]], file_path: str, temp_dir: str,
-                  memory_limit: str, compression: str) -> Tuple[int, str]:
-    """Process a specific chunk of the file into a temporary database."""
-    chunk_id, (start_pos, end_pos) = chunk_info
-    
-    # Create a unique temp database for this chunk
-    temp_db_path = os.path.join(temp_dir, f"chunk_{chunk_id}.duckdb")
+def stream_byte_range(file_path: str, start_pos: int, end_pos: int, pipe_w: int,
+                      errors: List[BaseException]):
+    """Write a byte range of the file into a pipe without buffering it in Python."""
+    # Closing pipe_w looks like a clean EOF to DuckDB whatever happened here,
+    # so failures are handed back through errors for the caller to raise
+    try:
+        src_fd = os.open(file_path, os.O_RDONLY)
+        try:
+            # Sequential readahead plus an early prefetch of this range, so the
+            # pages are in cache by the time the COPY asks for them. The advice
+            # values are not bit flags, hence two calls
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(src_fd, start_pos, end_pos - start_pos, os.POSIX_FADV_SEQUENTIAL)
+                os.posix_fadvise(src_fd, start_pos, end_pos - start_pos, os.POSIX_FADV_WILLNEED)
+            
+            offset = start_pos
+            use_sendfile = hasattr(os, 'sendfile')
+            if use_sendfile:
+                # Kernel-side copy from the page cache into the pipe
+                try:
+                    while offset < end_pos:
+                        sent = os.sendfile(pipe_w, src_fd, offset, end_pos - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                except OSError as e:
+                    # macOS/BSD sendfile only writes to sockets; fall back if
+                    # it refused the pipe before sending anything
+                    if offset != start_pos or e.errno not in SENDFILE_UNSUPPORTED:
+                        raise
+                    use_sendfile = False
+            if not use_sendfile:
+                with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)
+                    try:
+                        while offset < min(end_pos, len(mm)):
+                            offset += os.write(pipe_w, view[offset:min(end_pos, offset + (1 << 20))])
+                    finally:
+                        view.release()
+            
+            if offset < end_pos:
+                raise IOError(f"{file_path} ended at byte {offset:,}, expected {end_pos:,}")
+        finally:
+            os.close(src_fd)
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        os.close(pipe_w)
+
+def report_rejects(conn: duckdb.DuckDBPyConnection, rejects_table: str, rejects_scan: str,
+                   source: str):
+    """Log rows the CSV reader rejected, then drop its rejects tables."""
+    # One bad line can produce several error records (e.g. one per missing
+    # column), so count distinct lines rather than records
+    rejected = conn.execute(
+        f"SELECT COUNT(*) FROM (SELECT DISTINCT scan_id, file_id, line FROM {rejects_table})"
+    ).fetchone()[0]
+    if rejected:
+        line, error = conn.execute(
+            f"SELECT line, error_message FROM {rejects_table} ORDER BY line LIMIT 1"
+        ).fetchone()
+        print(f"Warning: skipped {rejected:,} malformed lines in {source} "
+              f"(first at line {line}: {error})")
     
-    # Connect to temporary database
-    conn = duckdb.connect(temp_db_path)
-    conn.execute(f"PRAGMA memory_limit='{memory_limit}'")
+    conn.execute(f"DROP TABLE IF EXISTS {rejects_table}")
+    conn.execute(f"DROP TABLE IF EXISTS {rejects_scan}")
+
+def _init_worker(conn: duckdb.DuckDBPyConnection, cursors: List[duckdb.DuckDBPyConnection]):
+    """Open one cursor per worker thread, reused for every chunk it loads."""
+    _worker.cursor = conn.cursor()
+    cursors.append(_worker.cursor)
+
+def process_chunk(chunk_info: Tuple[int, Tuple[int, int]], file_path: str,
+                  compression: str) -> int:
+    """Append a specific chunk of the file to the shared database."""
+    chunk_id, (start_pos, end_pos) = chunk_info
     
-    # Create the domains table in the temp database
-    conn.execute("""
-    CREATE TABLE domains (
-        domain VARCHAR,
-        nameservers VARCHAR,
-        ip VARCHAR,
-        country VARCHAR,
-        server VARCHAR,
-        field5 VARCHAR,
-        field6 VARCHAR,
-        field7 VARCHAR,
-        field8 VARCHAR
-    );
-    """)
+    # Each worker has its own cursor on the shared engine; concurrent appends
+    # to the same table are allowed within one DuckDB process
+    cursor = _worker.cursor
     
-    # Prepare the COPY statement
-    copy_options = f"(DELIMITER ';', HEADER 0, QUOTE '\"'"
+    # Prepare the COPY statement; malformed rows go to per-chunk rejects tables
+    # (temporary, so private to this cursor) instead of failing the chunk
+    rejects_table = f"rejects_c{chunk_id}"
+    rejects_scan = f"rejects_scan_c{chunk_id}"
+    copy_options = f"(DELIMITER ';', HEADER 0, QUOTE '\"', IGNORE_ERRORS TRUE, STORE_REJECTS TRUE"
+    copy_options += f", REJECTS_TABLE '{rejects_table}', REJECTS_SCAN '{rejects_scan}'"
     if compression != 'none' and compression != 'uncompressed':
         copy_options += f", COMPRESSION '{compression}'"
     copy_options += ")"
     
-    # Extract chunk to temporary file
-    rows_in_chunk = 0
-    temp_file = os.path.join(temp_dir, f"chunk_{chunk_id}.csv")
+    # Stream the byte range straight from the source file into DuckDB
+    feeder_errors = []
+    pipe_r, pipe_w = os.pipe()
+    feeder = threading.Thread(target=stream_byte_range,
+                              args=(file_path, start_pos, end_pos, pipe_w, feeder_errors))
+    feeder.start()
+    
+    # One transaction per chunk, so a chunk that couldn't be read in full
+    # leaves no rows behind
+    cursor.execute("BEGIN TRANSACTION")
     try:
-        # Read the chunk from the file
-        with open(file_path, 'rb') as f:
-            f.seek(start_pos)
-            data = f.read(end_pos - start_pos)
-        
-        # Count rows
-        rows_in_chunk = data.count(b'\n')
-        if data[-1:] != b'\n':
-            rows_in_chunk += 1
-        
-        # Write to temporary file
-        with open(temp_file, 'wb') as f:
-            f.write(data)
+        try:
+            # Copy from the pipe into the final table; COPY reports the rows it loaded
+            rows_in_chunk = cursor.execute(
+                f"COPY domains FROM '/dev/fd/{pipe_r}' {copy_options}"
+            ).fetchone()[0]
+        finally:
+            # Closing the read end unblocks the feeder if the COPY bailed out early
+            os.close(pipe_r)
+            feeder.join()
         
-        # Copy from temp file to temp database
-        conn.execute(f"COPY domains FROM '{temp_file}' {copy_options}")
+        # A feeder failure ends the pipe early, which the COPY took as EOF
+        if feeder_errors:
+            raise IOError(f"Could not stream chunk {chunk_id} "
+                          f"(bytes {start_pos:,}-{end_pos:,})") from feeder_errors[0]
         
-    except Exception as e:
-        print(f"Error processing chunk {chunk_id}: {e}")
-        rows_in_chunk = 0
-    finally:
-        conn.close()
-        # Clean up temp file
-        try:
-            os.remove(temp_file)
-        except:
-            pass
+        # Line numbers in the rejects table count from the start of the chunk
+        report_rejects(cursor, rejects_table, rejects_scan,
+                       f"chunk {chunk_id} (starting at byte {start_pos:,})")
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
     
-    return (rows_in_chunk, temp_db_path)
+    return rows_in_chunk
 
-def merge_temp_databases(db_path: str, temp_dbs: List[str], memory_limit: str):
-    """Merge all temporary databases into the final database."""
-    # Create or connect to the main database
-    conn = duckdb.connect(db_path)
-    conn.execute(f"PRAGMA memory_limit='{memory_limit}'")
+def country_column_type(conn: duckdb.DuckDBPyConnection) -> str:
+    """Return the current data type of domains.country."""
+    return conn.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'domains' AND column_name = 'country'"
+    ).fetchone()[0]
+
+def drop_domain_indexes(conn: duckdb.DuckDBPyConnection):
+    """Drop every index on domains; create_indexes rebuilds them after the load."""
+    # DuckDB refuses to change a column's type, or replace the table, while
+    # any index exists on it
+    indexes = conn.execute(
+        "SELECT index_name FROM duckdb_indexes() WHERE table_name = 'domains'"
+    ).fetchall()
+    for (index_name,) in indexes:
+        conn.execute(f"DROP INDEX {index_name}")
+
+def reopen_country_column(conn: duckdb.DuckDBPyConnection):
+    """Turn an ENUM country column from an earlier load back into VARCHAR."""
+    if country_column_type(conn) == 'VARCHAR':
+        return
     
-    # Ensure the domains table exists
+    # New files may carry codes the existing ENUM lacks, and that cast isn't
+    # covered by ignore_errors; the ENUM is rebuilt from old and new values
+    # after the load
+    print("Existing database: reopening country column for new values...")
+    drop_domain_indexes(conn)
+    conn.execute("ALTER TABLE domains ALTER country SET DATA TYPE VARCHAR")
+
+def create_country_enum(conn: duckdb.DuckDBPyConnection):
+    """Build the country_enum type from the distinct loaded country codes."""
+    # Only a column scan of the loaded table; ENUM codes compress to a single
+    # byte per row and give row groups tight min/max statistics. A type left
+    # over from an interrupted run, or the one reopen_country_column released,
+    # is no longer referenced and can be replaced
+    conn.execute("DROP TYPE IF EXISTS country_enum")
     conn.execute("""
-    CREATE TABLE IF NOT EXISTS domains (
-        domain VARCHAR,
-        nameservers VARCHAR,
-        ip VARCHAR,
-        country VARCHAR,
-        server VARCHAR,
-        field5 VARCHAR,
-        field6 VARCHAR,
-        field7 VARCHAR,
-        field8 VARCHAR
-    );
+    CREATE TYPE country_enum AS ENUM (
+        SELECT DISTINCT country FROM domains WHERE country IS NOT NULL ORDER BY country
+    )
     """)
-    
-    # Attach and merge each temp database
-    total_rows = 0
-    for i, temp_db in enumerate(temp_dbs):
-        try:
-            # Skip empty or corrupted databases
-            if not os.path.exists(temp_db) or os.path.getsize(temp_db) < 1000:
-                continue
-                
-            print(f"Merging database {i+1}/{len(temp_dbs)}: {temp_db}")
-            
-            # Attach the temp database
-            conn.execute(f"ATTACH '{temp_db}' AS temp_db")
-            
-            # Count rows to add
-            rows_to_add = conn.execute("SELECT COUNT(*) FROM temp_db.domains").fetchone()[0]
-            
-            # Insert data from temp database
-            conn.execute("INSERT INTO domains SELECT * FROM temp_db.domains")
-            
-            # Update total
-            total_rows += rows_to_add
-            
-            # Detach the temp database
-            conn.execute("DETACH temp_db")
-            
-            # Optional: remove the temp database file
-            os.remove(temp_db)
-            
-        except Exception as e:
-            print(f"Error merging database {temp_db}: {e}")
-    
-    conn.close()
-    return total_rows
 
-def load_direct_copy(file_path: str, db_path: str, memory_limit: str, 
-                     compression: str) -> int:
-    """Load the entire file using a direct COPY statement."""
-    conn = setup_database(db_path, memory_limit)
+def convert_country_to_enum(conn: duckdb.DuckDBPyConnection):
+    """Re-type the country column as an ENUM built from the loaded values."""
+    if country_column_type(conn) != 'VARCHAR':
+        return
     
-    # Prepare the COPY statement
-    copy_options = f"(DELIMITER ';', HEADER 0, QUOTE '\"'"
+    print("Converting country to ENUM...")
+    # Databases from older runs can hold a VARCHAR country and its indexes
+    drop_domain_indexes(conn)
+    create_country_enum(conn)
+    conn.execute("ALTER TABLE domains ALTER country SET DATA TYPE country_enum")
+
+def csv_source(file_path: str, compression: str) -> str:
+    """Build the read_csv() call for the semicolon-delimited input file."""
+    columns = ", ".join(f"'{column}': 'VARCHAR'" for column in DOMAIN_COLUMNS)
+    csv_options = f"delim=';', header=false, quote='\"', parallel=true, columns={{{columns}}}"
+    # Skip malformed rows into DuckDB's default reject_errors/reject_scans tables
+    csv_options += ", ignore_errors=true, store_rejects=true"
     if compression != 'none' and compression != 'uncompressed':
-        copy_options += f", COMPRESSION '{compression}'"
-    copy_options += ")"
-    
-    # Execute the COPY command
-    conn.execute(f"COPY domains FROM '{file_path}' {copy_options}")
+        csv_options += f", compression='{compression}'"
+    return f"read_csv('{file_path}', {csv_options})"
+
+def convert_to_parquet(conn: duckdb.DuckDBPyConnection, file_path: str, parquet_path: str,
+                       compression: str):
+    """Convert the CSV input into a columnar Parquet file for faster reloads."""
+    # Write to a side file first so an interrupted run never leaves a
+    # truncated Parquet file that later runs would pick up
+    partial_path = f"{parquet_path}.tmp"
+    conn.execute(f"""
+    COPY (SELECT * FROM {csv_source(file_path, compression)})
+    TO '{partial_path}' (FORMAT PARQUET, ROW_GROUP_SIZE 122880, COMPRESSION ZSTD)
+    """)
+    report_rejects(conn, 'reject_errors', 'reject_scans', file_path)
+    os.replace(partial_path, parquet_path)
+
+def load_direct_copy(conn: duckdb.DuckDBPyConnection, file_path: str, 
+                     compression: str, to_parquet: bool = False) -> int:
+    """Load the entire file sorted by country in a single parallel statement."""
+    # Pay the CSV tokenizing cost once, then reload from Parquet on later runs
+    source = csv_source(file_path, compression)
+    if to_parquet:
+        parquet_path = f"{file_path}.parquet"
+        if not os.path.exists(parquet_path):
+            print(f"Converting {file_path} to {parquet_path}...")
+            convert_to_parquet(conn, file_path, parquet_path, compression)
+        else:
+            print(f"Reusing existing {parquet_path}")
+        source = f"read_parquet('{parquet_path}')"
     
-    # Count the rows
-    row_count = conn.execute("SELECT COUNT(*) FROM domains").fetchone()[0]
-    conn.close()
+    # Append and re-type in one transaction, so a failure part way through
+    # leaves an earlier load as it was and the run can simply be repeated
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        # Appending to an earlier load: accept country codes its ENUM doesn't know
+        reopen_country_column(conn)
+        
+        # Sorting on load clusters each country into few row groups, so zone maps
+        # can skip the rest on country filters. INSERT reports the rows it wrote,
+        # which saves a full COUNT(*) scan afterwards
+        row_count = conn.execute(f"""
+        INSERT INTO domains
+        SELECT * FROM {source}
+        ORDER BY country
+        """).fetchone()[0]
+        if not to_parquet:
+            report_rejects(conn, 'reject_errors', 'reject_scans', file_path)
+        
+        convert_country_to_enum(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
     
     return row_count
 
-def create_indexes(db_path: str):
-    """Create indexes after data is loaded."""
-    conn = duckdb.connect(db_path)
+def create_indexes(conn: duckdb.DuckDBPyConnection):
+    """Create indexes on the connection that did the load, while its cache is warm."""
+    # Flush the WAL once so index builds don't interleave with log replay
+    conn.execute("CHECKPOINT")
     
     print("Creating indexes...")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_domain ON domains(domain)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_ip ON domains(ip)")
-    conn.execute("CREATE INDEX IF NOT EXISTS idx_country ON domains(country)")
+    # No ART index on country: the table is sorted by it, so zone maps
+    # already skip non-matching row groups for country filters
     
     print("Running ANALYZE to optimize query planning...")
     try:
         conn.execute("ANALYZE domains")
     except:
         print("Note: ANALYZE command not available in this DuckDB version. Indexes are still created.")
-    
-    conn.close()
 
 def main():
     args = parse_args()
-    start_time = time.time()
-    
-    # Determine total rows (exact number from argument or estimate)
-    total_rows = 217038672  # Set to the exact number you know
     
-    # Create temp directory if it doesn't exist
-    if not os.path.exists(args.temp_dir):
-        os.makedirs(args.temp_dir)
-    
-    if args.direct:
-        print(f"Using direct COPY to load data from {args.file}...")
-        rows_loaded = load_direct_copy(
-            args.file, args.db_path, args.memory_limit, args.compression
-        )
-    else:
-        # Split the file into chunks
-        chunks = get_file_chunks(args.file, total_rows, args.chunk_size)
-        print(f"Split file into {len(chunks)} chunks")
+    # Scratch space for DuckDB spill files (sorts, index builds), removed
+    # however the run ends. By default it sits next to the database, where
+    # DuckDB would spill anyway; /tmp may be a small tmpfs. Pass --temp-dir
+    # /dev/shm to keep spills off disk if RAM allows
+    spill_parent = args.temp_dir or os.path.dirname(os.path.abspath(args.db_path))
+    os.makedirs(spill_parent, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=spill_parent) as spill_dir:
+        start_time = time.time()
         
-        # Add chunk IDs
-        chunks_with_ids = [(i, chunk) for i, chunk in enumerate(chunks)]
+        # Determine total rows (exact number from argument or estimate)
+        total_rows = 217038672  # Set to the exact number you know
         
-        # Determine parallelism
-        workers = min(args.workers, len(chunks))
-        print(f"Using {workers} parallel workers for loading...")
+        # One connection for load, indexing and verification, so the buffer
+        # pool stays hot between phases
+        conn = setup_database(args.db_path, args.memory_limit)
+        conn.execute(f"PRAGMA temp_directory='{spill_dir}'")
         
-        # Process chunks in parallel, each into a separate temp database
-        process_func = partial(process_chunk, 
-                              file_path=args.file,
-                              temp_dir=args.temp_dir,
-                              memory_limit=args.memory_limit,
-                              compression=args.compression)
+        # Parquet reloads are columnar and need no byte-range chunking
+        if args.to_parquet or not args.chunked:
+            print(f"Using direct COPY to load data from {args.file}...")
+            rows_loaded = load_direct_copy(
+                conn, args.file, args.compression, to_parquet=args.to_parquet
+            )
+        else:
+            # Appending to an earlier load: accept country codes its ENUM doesn't know
+            reopen_country_column(conn)
+            
+            # Split the file into chunks
+            chunks = get_file_chunks(args.file, total_rows, args.chunk_size)
+            print(f"Split file into {len(chunks)} chunks")
+            
+            # Add chunk IDs
+            chunks_with_ids = [(i, chunk) for i, chunk in enumerate(chunks)]
+            
+            # Determine parallelism
+            workers = min(args.workers, len(chunks))
+            print(f"Using {workers} parallel workers for loading...")
+            
+            # Process chunks in parallel, each worker on its own cursor of the shared connection
+            process_func = partial(process_chunk, 
+                                  file_path=args.file,
+                                  compression=args.compression)
+            
+            rows_loaded = 0
+            pending_rows = 0
+            worker_cursors = []
+            
+            try:
+                with ThreadPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(conn, worker_cursors)) as executor:
+                    futures = [executor.submit(process_func, chunk) for chunk in chunks_with_ids]
+                    try:
+                        with tqdm(total=total_rows, desc="Processing chunks",
+                                  miniters=PROGRESS_BATCH_ROWS, mininterval=0.5, smoothing=0) as pbar:
+                            for future in as_completed(futures):
+                                rows = future.result()
+                                rows_loaded += rows
+                                
+                                # Refresh the bar in batches rather than once per chunk
+                                pending_rows += rows
+                                if pending_rows >= PROGRESS_BATCH_ROWS:
+                                    pbar.update(pending_rows)
+                                    pending_rows = 0
+                            pbar.update(pending_rows)
+                    except BaseException:
+                        # Stop queued chunks from loading after a failure; only
+                        # the ones already running finish before the error surfaces
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        raise
+            finally:
+                for cursor in worker_cursors:
+                    cursor.close()
+            
+            print(f"Processed {rows_loaded:,} rows")
+            
+            # Chunks land in completion order; cluster by country like the direct
+            # path, casting to the ENUM in the same rewrite so the table is
+            # written only once more
+            print("Sorting table by country and converting country to ENUM...")
+            drop_domain_indexes(conn)
+            create_country_enum(conn)
+            conn.execute("""
+            CREATE OR REPLACE TABLE domains AS
+            SELECT * REPLACE (CAST(country AS country_enum) AS country)
+            FROM domains
+            ORDER BY country
+            """)
         
-        temp_dbs = []
-        rows_processed = 0
+        # Create indexes after loading
+        create_indexes(conn)
         
-        with multiprocessing.Pool(workers) as pool:
-            with tqdm(total=total_rows, desc="Processing chunks") as pbar:
-                for rows, temp_db in pool.imap_unordered(process_func, chunks_with_ids):
-                    rows_processed += rows
-                    if rows > 0:  # Only add non-empty databases
-                        temp_dbs.append(temp_db)
-                    pbar.update(rows)
+        end_time = time.time()
+        duration = end_time - start_time
         
-        print(f"Processed {rows_processed:,} rows into {len(temp_dbs)} temporary databases")
-        print("Merging databases...")
+        print(f"\nLoaded {rows_loaded:,} rows in {duration:.2f} seconds")
+        print(f"Average speed: {rows_loaded / duration:,.2f} rows/second")
         
-        # Merge all temp databases into final database
-        rows_loaded = merge_temp_databases(args.db_path, temp_dbs, args.memory_limit)
+        # Stats summary
+        if duration > 60:
+            minutes = int(duration / 60)
+            seconds = duration % 60
+            print(f"Total time: {minutes} minutes and {seconds:.2f} seconds")
         
-        # Clean up temp directory if it's empty
-        remaining_files = glob.glob(os.path.join(args.temp_dir, "*"))
-        if not remaining_files:
-            try:
-                os.rmdir(args.temp_dir)
-            except:
-                pass
-    
-    # Create indexes after loading
-    create_indexes(args.db_path)
-    
-    end_time = time.time()
-    duration = end_time - start_time
-    
-    print(f"\nLoaded {rows_loaded:,} rows in {duration:.2f} seconds")
-    print(f"Average speed: {rows_loaded / duration:,.2f} rows/second")
-    
-    # Stats summary
-    if duration > 60:
-        minutes = int(duration / 60)
-        seconds = duration % 60
-        print(f"Total time: {minutes} minutes and {seconds:.2f} seconds")
-    
-    # Estimate query performance
-    conn = duckdb.connect(args.db_path)
-    try:
-        table_size = conn.execute("SELECT pg_table_size('domains')").fetchone()[0]
-        print(f"Table size: {table_size / (1024*1024*1024):.2f} GB")
+        # Estimate query performance
+        # Storage size straight from the catalog; this covers the whole
+        # database file, so the indexes built above are included
+        database_size = conn.execute(
+            "SELECT used_blocks * block_size FROM pragma_database_size()"
+        ).fetchone()[0]
+        print(f"Database size (table + indexes): {database_size / (1024*1024*1024):.2f} GB")
         
         # Check if file size is reasonable compared to input file
         input_size = os.path.getsize(args.file)
-        ratio = table_size / input_size
-        print(f"Storage efficiency: {ratio:.2f}x original file size")
-    except:
-        print("Note: Could not determine table size statistics with this DuckDB version.")
-    
-    # Verify a random query is fast
-    query_start = time.time()
-    result = conn.execute("SELECT COUNT(*) FROM domains WHERE country = 'US'").fetchone()[0]
-    query_time = (time.time() - query_start) * 1000
-    print(f"Verification query: {result:,} US domains found in {query_time:.2f} ms")
-    
-    conn.close()
+        ratio = database_size / input_size
+        print(f"Storage efficiency: {ratio:.2f}x original file size (including indexes)")
+        
+        # Verify a random query is fast
+        query_start = time.time()
+        result = conn.execute("SELECT COUNT(*) FROM domains WHERE country = 'US'").fetchone()[0]
+        query_time = (time.time() - query_start) * 1000
+        print(f"Verification query: {result:,} US domains found in {query_time:.2f} ms")
+        
+        conn.close()
 
 if __name__ == "__main__":
     main()